@@ -1,103 +1,392 @@
-"""Aggregation functions for player analytics (stdlib only)."""
+"""Aggregation functions for player analytics (stdlib only).
+
+The server keeps an ``AggregateState`` up to date as events arrive and are
+evicted (see ``make_ingest`` and ``make_discard``) and renders GET responses
+from it. The ``compute_*`` functions
+are kept for batch re-aggregation: they replay a list of log entries into a
+fresh ``AggregateState`` and render it the same way.
+"""
+
+from collections import Counter, deque
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, NamedTuple
+
+
+class AggregateState:
+    """Running aggregates, updated once per ingested event."""
+
+    def __init__(self) -> None:
+        self.total_choices = 0
+        # Sessions that made at least one choice (for uniqueSessions)
+        self.choice_sessions: set[str] = set()
+        # knotPath -> choiceIndex -> { count, text }
+        self.path_distribution: dict[str, dict[Any, dict[str, Any]]] = {}
+        # knotPath -> number of choices (for top paths)
+        self.knot_path_counts: Counter[str] = Counter()
+        # knot -> number of choices (denominator for choice percentages)
+        self.knot_totals: Counter[str] = Counter()
+        # "knot:choiceIndex" -> number of choices
+        self.choice_counts: Counter[str] = Counter()
+        # sessionId -> session summary, with paths as an insertion-ordered
+        # dict of knotPath -> number of visits (rendered as a list). Sessions
+        # and paths keep the order first seen, even once those events are
+        # evicted.
+        self.session_state: dict[str, dict[str, Any]] = {}
+        # (knotPath, choiceIndex) -> runs of [choiceText, count] in arrival
+        # order, only for choices seen with more than one text. Eviction uses
+        # them to find the text of the oldest choice left.
+        self.text_runs: dict[tuple[Any, Any], deque[list[Any]]] = {}
+
+    def clear(self) -> None:
+        """Reset all aggregates, keeping the same container objects."""
+        self.total_choices = 0
+        self.choice_sessions.clear()
+        self.path_distribution.clear()
+        self.knot_path_counts.clear()
+        self.knot_totals.clear()
+        self.choice_counts.clear()
+        self.session_state.clear()
+        self.text_runs.clear()
+
+
+class ChoiceEvent(NamedTuple):
+    """
+    Fields of a "choice" log entry, normalized once at ingest.
+
+    The types are those of a well-formed event; the payload is stored as
+    sent, so a client may put any JSON scalar in these fields.
+    """
 
-from typing import Any
+    # payload.knotPath, or "unknown" if missing
+    knot_path: str
+    # payload.knotPath, else context.knot, else "unknown"
+    knot: str
+    # payload.choiceIndex, or -1 if missing
+    choice_index: int
+    # payload.choiceText, or "" if missing
+    choice_text: str
+    # payload.knotPath if truthy, else None (recorded in session paths)
+    visited_path: str | None
 
 
-def compute_path_stats(entries: list[dict[str, Any]]) -> dict[str, Any]:
+def parse_choice(entry: dict[str, Any]) -> ChoiceEvent | None:
     """
-    Compute path statistics from logged events.
+    Normalize a log entry into a ChoiceEvent.
 
     Args:
-        entries: Array of log entries
+        entry: Log entry
 
     Returns:
-        Dict with totalChoices, uniqueSessions, pathDistribution
+        ChoiceEvent, or None if the entry is not a choice
     """
-    choices = [e for e in entries if e.get("type") == "choice"]
+    if entry.get("type") != "choice":
+        return None
+
+    payload = entry.get("payload") or {}
+    knot_path = payload.get("knotPath")
+    return ChoiceEvent(
+        knot_path=payload.get("knotPath", "unknown"),
+        knot=knot_path or (entry.get("context") or {}).get("knot") or "unknown",
+        choice_index=payload.get("choiceIndex", -1),
+        choice_text=payload.get("choiceText", ""),
+        visited_path=knot_path or None,
+    )
+
+
+def make_ingest(
+    state: AggregateState,
+) -> Callable[[dict[str, Any], ChoiceEvent | None], None]:
+    """
+    Specialize ingestion for one AggregateState.
 
-    # Group by knotPath -> choiceIndex -> { count, text }
-    by_path: dict[str, dict[int, dict[str, Any]]] = {}
-    sessions: set[str] = set()
+    The state's containers are bound once as closure variables, so the
+    returned function does no attribute lookups on ``state`` per event
+    (other than the choice total). ``AggregateState.clear`` empties the
+    containers in place, so the function stays valid across clears.
 
-    for c in choices:
-        sessions.add(c.get("sessionId", ""))
+    Args:
+        state: Aggregates to update in place
 
-        payload = c.get("payload") or {}
-        path = payload.get("knotPath", "unknown")
-        choice_index = payload.get("choiceIndex", -1)
+    Returns:
+        ``ingest(entry, choice)``, taking a log entry and
+        ``parse_choice(entry)``
+    """
+    session_state = state.session_state
+    choice_sessions_add = state.choice_sessions.add
+    path_distribution = state.path_distribution
+    knot_path_counts = state.knot_path_counts
+    knot_totals = state.knot_totals
+    choice_counts = state.choice_counts
+    text_runs = state.text_runs
+
+    def ingest(entry: dict[str, Any], choice: ChoiceEvent | None) -> None:
+        """Fold a single log entry into the running aggregates."""
+        sid = entry.get("sessionId", "")
+        timestamp = entry.get("timestamp", 0)
 
-        if path not in by_path:
-            by_path[path] = {}
-        if choice_index not in by_path[path]:
-            by_path[path][choice_index] = {
-                "count": 0,
-                "text": payload.get("choiceText", ""),
+        s = session_state.get(sid)
+        if s is None:
+            s = session_state[sid] = {
+                "sessionId": sid,
+                "startTime": timestamp,
+                "endTime": timestamp,
+                "choiceCount": 0,
+                "paths": {},
+                "durationMs": 0,
             }
-        by_path[path][choice_index]["count"] += 1
+        elif timestamp < s["startTime"]:
+            s["startTime"] = timestamp
+            s["durationMs"] = s["endTime"] - timestamp
+        elif timestamp > s["endTime"]:
+            s["endTime"] = timestamp
+            s["durationMs"] = timestamp - s["startTime"]
+
+        if choice is None:
+            return
+
+        knot_path, knot, choice_index, choice_text, visited_path = choice
+
+        # Session summary
+        s["choiceCount"] += 1
+        if visited_path:
+            paths = s["paths"]
+            paths[visited_path] = paths.get(visited_path, 0) + 1
+
+        # Path statistics
+        state.total_choices += 1
+        choice_sessions_add(sid)
+        by_index = path_distribution.get(knot_path)
+        if by_index is None:
+            by_index = path_distribution[knot_path] = {}
+        data = by_index.get(choice_index)
+        if data is None:
+            data = by_index[choice_index] = {"count": 0, "text": choice_text}
+        elif text_runs or choice_text != data["text"]:
+            key = (knot_path, choice_index)
+            runs = text_runs.get(key)
+            if runs is None:
+                if choice_text != data["text"]:
+                    text_runs[key] = deque(
+                        [[data["text"], data["count"]], [choice_text, 1]]
+                    )
+            elif runs[-1][0] == choice_text:
+                runs[-1][1] += 1
+            else:
+                runs.append([choice_text, 1])
+        data["count"] += 1
+
+        # Top paths
+        knot_path_counts[knot_path] += 1
+
+        # Choice statistics
+        knot_totals[knot] += 1
+        choice_counts[f"{knot}:{choice_index}"] += 1
+
+    return ingest
+
+
+def make_discard(
+    state: AggregateState,
+) -> Callable[[dict[str, Any], ChoiceEvent | None], None]:
+    """
+    Specialize un-counting of evicted events for one AggregateState.
 
-    # Convert int keys to strings for JSON compatibility
-    path_distribution = {
-        path: {str(idx): data for idx, data in choices_map.items()}
-        for path, choices_map in by_path.items()
-    }
+    The inverse of ``make_ingest``, for events discarded oldest first. A
+    session's start and end times can't be un-counted event by event;
+    ``update_session_times`` recomputes them once the events are gone.
+
+    Args:
+        state: Aggregates to update in place
+
+    Returns:
+        ``discard(entry, choice)``, taking a log entry and
+        ``parse_choice(entry)``
+    """
+    session_state = state.session_state
+    choice_sessions = state.choice_sessions
+    path_distribution = state.path_distribution
+    knot_path_counts = state.knot_path_counts
+    knot_totals = state.knot_totals
+    choice_counts = state.choice_counts
+    text_runs = state.text_runs
+
+    def uncount(counter: dict[Any, int], key: Any) -> None:
+        # Drop keys that reach zero, as a fresh count would not have them
+        count = counter[key] - 1
+        if count:
+            counter[key] = count
+        else:
+            del counter[key]
+
+    def discard(entry: dict[str, Any], choice: ChoiceEvent | None) -> None:
+        """Remove a single log entry from the running aggregates."""
+        if choice is None:
+            return
+
+        knot_path, knot, choice_index, _, visited_path = choice
+        sid = entry.get("sessionId", "")
+
+        # Session summary
+        s = session_state[sid]
+        s["choiceCount"] -= 1
+        if not s["choiceCount"]:
+            choice_sessions.discard(sid)
+        if visited_path:
+            uncount(s["paths"], visited_path)
+
+        # Path statistics
+        state.total_choices -= 1
+        by_index = path_distribution[knot_path]
+        data = by_index[choice_index]
+        data["count"] -= 1
+        if not data["count"]:
+            del by_index[choice_index]
+            if not by_index:
+                del path_distribution[knot_path]
+        elif text_runs:
+            runs = text_runs.get((knot_path, choice_index))
+            if runs is not None:
+                runs[0][1] -= 1
+                if not runs[0][1]:
+                    runs.popleft()
+                    data["text"] = runs[0][0]
+                    if len(runs) == 1:
+                        del text_runs[(knot_path, choice_index)]
+
+        # Top paths
+        uncount(knot_path_counts, knot_path)
+
+        # Choice statistics
+        uncount(knot_totals, knot)
+        uncount(choice_counts, f"{knot}:{choice_index}")
+
+    return discard
+
+
+def update_session_times(
+    state: AggregateState,
+    sid: str,
+    discarded: list[dict[str, Any]],
+    entries: list[dict[str, Any]],
+) -> None:
+    """
+    Bring a session's times up to date after some of its events are gone.
 
+    The times are only recomputed if a discarded event set one of them. A
+    session with no events left is dropped.
+
+    Args:
+        state: Aggregates to update in place
+        sid: Session ID
+        discarded: The session's log entries passed to ``discard``
+        entries: The session's remaining log entries
+    """
+    if not entries:
+        del state.session_state[sid]
+        return
+
+    s = state.session_state[sid]
+    bounds = (s["startTime"], s["endTime"])
+    if not any(entry.get("timestamp", 0) in bounds for entry in discarded):
+        return
+
+    timestamps = [entry.get("timestamp", 0) for entry in entries]
+    start = min(timestamps)
+    end = max(timestamps)
+    s["startTime"] = start
+    s["endTime"] = end
+    # Ingest leaves the duration at 0 until the times first differ
+    s["durationMs"] = end - start if end != start else 0
+
+
+def render_path_stats(state: AggregateState) -> dict[str, Any]:
+    """Render ``compute_path_stats`` output from running aggregates."""
     return {
-        "totalChoices": len(choices),
-        "uniqueSessions": len(sessions),
-        "pathDistribution": path_distribution,
+        "totalChoices": state.total_choices,
+        "uniqueSessions": len(state.choice_sessions),
+        "pathDistribution": {
+            path: {str(idx): data for idx, data in choices_map.items()}
+            for path, choices_map in state.path_distribution.items()
+        },
     }
 
 
-def compute_session_summaries(entries: list[dict[str, Any]]) -> list[dict[str, Any]]:
+def render_session_summaries(state: AggregateState) -> Iterator[dict[str, Any]]:
+    """Yield ``compute_session_summaries`` items from running aggregates."""
+    for s in state.session_state.values():
+        yield {**s, "paths": list(s["paths"])}
+
+
+def render_top_paths(state: AggregateState, limit: int = 10) -> list[dict[str, Any]]:
+    """Render ``top_paths`` output from running aggregates."""
+    return [
+        {"path": path, "count": count}
+        for path, count in state.knot_path_counts.most_common(limit)
+    ]
+
+
+def render_choice_stats(
+    state: AggregateState, choice_ids: list[str]
+) -> dict[str, Any]:
+    """Render ``compute_choice_stats`` output from running aggregates."""
+    choice_counts = state.choice_counts
+    knot_totals = state.knot_totals
+    result: dict[str, dict[str, int]] = {}
+    for choice_id in choice_ids:
+        count = choice_counts[choice_id]
+        # Only choices that were made need their knot split out of the ID
+        if count:
+            total = knot_totals.get(choice_id.partition(":")[0], 1)
+            result[choice_id] = {
+                "total": count,
+                "percentage": round((count / total) * 100),
+            }
+        else:
+            result[choice_id] = {"total": 0, "percentage": 0}
+
+    return {"choices": result}
+
+
+def _aggregate(entries: Iterable[dict[str, Any]]) -> AggregateState:
+    """Fold log entries into a fresh AggregateState."""
+    state = AggregateState()
+    ingest = make_ingest(state)
+    for entry in entries:
+        ingest(entry, parse_choice(entry))
+    return state
+
+
+def compute_path_stats(entries: Iterable[dict[str, Any]]) -> dict[str, Any]:
     """
-    Compute session summaries.
+    Compute path statistics from logged events.
 
     Args:
         entries: Array of log entries
 
     Returns:
-        List of session summaries
+        Dict with totalChoices, uniqueSessions, pathDistribution
     """
-    sessions: dict[str, dict[str, Any]] = {}
+    return render_path_stats(_aggregate(entries))
 
-    for entry in entries:
-        sid = entry.get("sessionId", "")
-        timestamp = entry.get("timestamp", 0)
 
-        if sid not in sessions:
-            sessions[sid] = {
-                "sessionId": sid,
-                "startTime": timestamp,
-                "endTime": timestamp,
-                "choiceCount": 0,
-                "paths": set(),
-            }
-
-        s = sessions[sid]
-        s["startTime"] = min(s["startTime"], timestamp)
-        s["endTime"] = max(s["endTime"], timestamp)
+def compute_session_summaries(
+    entries: Iterable[dict[str, Any]],
+) -> list[dict[str, Any]]:
+    """
+    Compute session summaries.
 
-        if entry.get("type") == "choice":
-            s["choiceCount"] += 1
-            payload = entry.get("payload") or {}
-            knot_path = payload.get("knotPath")
-            if knot_path:
-                s["paths"].add(knot_path)
+    Args:
+        entries: Array of log entries
 
-    return [
-        {
-            "sessionId": s["sessionId"],
-            "startTime": s["startTime"],
-            "endTime": s["endTime"],
-            "choiceCount": s["choiceCount"],
-            "paths": list(s["paths"]),
-            "durationMs": s["endTime"] - s["startTime"],
-        }
-        for s in sessions.values()
-    ]
+    Returns:
+        List of session summaries
+    """
+    return list(render_session_summaries(_aggregate(entries)))
 
 
-def top_paths(entries: list[dict[str, Any]], limit: int = 10) -> list[dict[str, Any]]:
+def top_paths(
+    entries: Iterable[dict[str, Any]], limit: int = 10
+) -> list[dict[str, Any]]:
     """
     Find most common choice paths.
 
@@ -108,21 +397,11 @@ def top_paths(entries: list[dict[str, Any]], limit: int = 10) -> list[dict[str,
     Returns:
         Top paths by frequency
     """
-    choices = [e for e in entries if e.get("type") == "choice"]
-    path_counts: dict[str, int] = {}
-
-    for c in choices:
-        payload = c.get("payload") or {}
-        path = payload.get("knotPath", "unknown")
-        path_counts[path] = path_counts.get(path, 0) + 1
-
-    sorted_paths = sorted(path_counts.items(), key=lambda x: x[1], reverse=True)
-
-    return [{"path": path, "count": count} for path, count in sorted_paths[:limit]]
+    return render_top_paths(_aggregate(entries), limit)
 
 
 def compute_choice_stats(
-    entries: list[dict[str, Any]], choice_ids: list[str]
+    entries: Iterable[dict[str, Any]], choice_ids: list[str]
 ) -> dict[str, Any]:
     """
     Compute statistics for specific choice IDs (Telltale-style).
@@ -136,40 +415,4 @@ def compute_choice_stats(
     Returns:
         Dict with choices mapping to total and percentage
     """
-    choices = [e for e in entries if e.get("type") == "choice"]
-
-    # Count totals per knot for percentage calculation
-    knot_totals: dict[str, int] = {}
-    choice_counts: dict[str, dict[str, Any]] = {}
-
-    for c in choices:
-        payload = c.get("payload") or {}
-        context = c.get("context") or {}
-        knot = payload.get("knotPath") or context.get("knot") or "unknown"
-        idx = payload.get("choiceIndex", -1)
-        key = f"{knot}:{idx}"
-
-        # Count per knot
-        knot_totals[knot] = knot_totals.get(knot, 0) + 1
-
-        # Count per choice
-        if key not in choice_counts:
-            choice_counts[key] = {"count": 0, "knot": knot}
-        choice_counts[key]["count"] += 1
-
-    # Build response for requested choice IDs
-    result: dict[str, dict[str, int]] = {}
-    for choice_id in choice_ids:
-        knot = choice_id.split(":")[0] if ":" in choice_id else choice_id
-        data = choice_counts.get(choice_id)
-
-        if data:
-            total = knot_totals.get(knot, 1)
-            result[choice_id] = {
-                "total": data["count"],
-                "percentage": round((data["count"] / total) * 100),
-            }
-        else:
-            result[choice_id] = {"total": 0, "percentage": 0}
-
-    return {"choices": result}
+    return render_choice_stats(_aggregate(entries), choice_ids)
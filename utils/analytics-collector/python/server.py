@@ -6,27 +6,362 @@ Aggregates player events from multiple sessions.
 
 import json
 import os
+import shutil
+import sys
+import threading
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from typing import Any
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import islice
+from typing import Any, BinaryIO
 from urllib.parse import urlparse, parse_qs
 
 from aggregate import (
-    compute_choice_stats,
-    compute_path_stats,
-    compute_session_summaries,
-    top_paths,
+    AggregateState,
+    ChoiceEvent,
+    make_discard,
+    make_ingest,
+    parse_choice,
+    render_choice_stats,
+    render_path_stats,
+    render_session_summaries,
+    render_top_paths,
+    update_session_times,
 )
 
 PORT = int(os.environ.get("PORT", 3001))
 
+# Stored history is capped; the oldest events are evicted beyond this
+MAX_EVENTS = int(os.environ.get("MAX_EVENTS", 1_000_000))
+
+# Optional JSON Lines file that stored events are saved to and reloaded from
+EVENTS_FILE = os.environ.get("EVENTS_FILE")
+
+
+def intern_strings(entry: dict[str, Any]) -> None:
+    """Intern an event's heavily repeated string fields in place.
+
+    Events from the same session and knot then share one string object,
+    and the dict lookups keyed on them compare by identity.
+    """
+    sid = entry.get("sessionId")
+    if isinstance(sid, str):
+        entry["sessionId"] = sys.intern(sid)
+    payload = entry.get("payload")
+    if isinstance(payload, dict):
+        for key in ("knotPath", "choiceText"):
+            value = payload.get(key)
+            if isinstance(value, str):
+                payload[key] = sys.intern(value)
+
+
+def entry_error(entry: Any) -> str | None:
+    """
+    Check that an event can be stored and aggregated.
+
+    Handlers check every entry of a request before taking db_lock, so a bad
+    entry rejects the whole request rather than leaving it half-applied.
+
+    Args:
+        entry: Log entry from a request body
+
+    Returns:
+        What is wrong with the entry, or None if it is valid
+    """
+    if not isinstance(entry, dict):
+        return "event must be an object"
+    # Used as dict keys by the store and the aggregates
+    for key in ("type", "sessionId"):
+        if isinstance(entry.get(key), (dict, list)):
+            return f"{key} must be a string"
+    # Compared and subtracted for session start/end times
+    if not isinstance(entry.get("timestamp", 0), (int, float)):
+        return "timestamp must be a number"
+    if entry.get("type") != "choice":
+        return None
+
+    payload = entry.get("payload")
+    context = entry.get("context")
+    if payload and not isinstance(payload, dict):
+        return "payload must be an object"
+    if context and not isinstance(context, dict):
+        return "context must be an object"
+    for key in ("knotPath", "choiceIndex"):
+        if isinstance((payload or {}).get(key), (dict, list)):
+            return f"payload.{key} must be a string or number"
+    if isinstance((context or {}).get("knot"), (dict, list)):
+        return "context.knot must be a string"
+    return None
+
+
+class EventStore:
+    """In-memory event storage, partitioned by type and session on append."""
+
+    def __init__(self) -> None:
+        # Bumped on every change, so cached responses can tell db has moved on
+        self.version = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        self.all: list[dict[str, Any]] = []
+        self.by_session: dict[str, list[dict[str, Any]]] = {}
+        self.by_type: dict[str, list[dict[str, Any]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.all)
+
+    def append(self, entry: dict[str, Any]) -> None:
+        """Store a single event."""
+        self.version += 1
+        self.all.append(entry)
+        self.by_session.setdefault(entry.get("sessionId", ""), []).append(entry)
+        self.by_type.setdefault(entry.get("type", ""), []).append(entry)
+
+    def evict(self, count: int) -> list[dict[str, Any]]:
+        """Remove and return the oldest ``count`` events."""
+        self.version += 1
+        evicted = self.all[:count]
+        del self.all[:count]
+        # The oldest events of any session or type are the first in its list
+        for index, key in ((self.by_session, "sessionId"), (self.by_type, "type")):
+            for name, n in Counter(e.get(key, "") for e in evicted).items():
+                events = index[name]
+                if n == len(events):
+                    del index[name]
+                else:
+                    del events[:n]
+        return evicted
+
+    def clear(self) -> None:
+        """Remove all stored events."""
+        self._reset()
+        self.version += 1
+
+    def filter(
+        self, event_type: str | None, session_id: str | None
+    ) -> list[dict[str, Any]]:
+        """Return stored events matching the given type and/or session."""
+        if event_type and session_id:
+            of_type = self.by_type.get(event_type, [])
+            of_session = self.by_session.get(session_id, [])
+            # Scan whichever index is shorter for the other condition
+            if len(of_type) <= len(of_session):
+                return [e for e in of_type if e.get("sessionId") == session_id]
+            return [e for e in of_session if e.get("type") == event_type]
+        if event_type:
+            return self.by_type.get(event_type, [])
+        if session_id:
+            return self.by_session.get(session_id, [])
+        return self.all
+
+
+class EventLog:
+    """Append-only JSON Lines file of stored events, replayed on startup."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file: BinaryIO | None = None
+        # Lines the last load() could not read back
+        self.skipped = 0
+
+    def load(self) -> Iterator[dict[str, Any]]:
+        """Yield the saved events, skipping lines that can't be read back
+        or that ``entry_error`` rejects."""
+        self.skipped = 0
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # e.g. a line cut short by a crash mid-write
+                    self.skipped += 1
+                    continue
+                # The file may have been edited, or written by an older version
+                if entry_error(entry) is None:
+                    yield entry
+                else:
+                    self.skipped += 1
+
+    def open(self) -> None:
+        """Open the file for appending, creating it if missing."""
+        self._file = open(self.path, "ab")
+
+    def append(self, entries: list[dict[str, Any]]) -> None:
+        """Save events to the end of the file (after ``open``)."""
+        assert self._file is not None, "EventLog.open() not called"
+        # Encode everything first, so a failure can't leave a partial batch
+        data = b"".join(encode_json(entry) + b"\n" for entry in entries)
+        self._file.write(data)
+        self._file.flush()
+
+    def rewrite(self, entries: list[dict[str, Any]]) -> None:
+        """Replace the file's contents with exactly these events."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.writelines(encode_json(entry) + b"\n" for entry in entries)
+        self._replace(tmp_path)
+
+    def trim(self, count: int, entries: list[dict[str, Any]]) -> None:
+        """Drop the oldest ``count`` saved events and append these, atomically."""
+        data = b"".join(encode_json(entry) + b"\n" for entry in entries)
+        tmp_path = f"{self.path}.tmp"
+        with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+            # The kept lines are copied as bytes, not decoded and re-encoded
+            for _ in islice(src, count):
+                pass
+            shutil.copyfileobj(src, dst)
+            dst.write(data)
+        self._replace(tmp_path)
+
+    def _replace(self, tmp_path: str) -> None:
+        self.close()
+        try:
+            os.replace(tmp_path, self.path)
+        finally:
+            self.open()
+
+    def close(self) -> None:
+        """Close the append handle, if open."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 # In-memory storage (use a real database for production)
-db: list[dict[str, Any]] = []
+db = EventStore()
+
+# Persistence for db, if EVENTS_FILE is set (see load_events_file)
+events_log: EventLog | None = None
+
+# Running aggregates, updated on ingest so GETs don't rescan db
+state = AggregateState()
+ingest = make_ingest(state)
+discard = make_discard(state)
+
+# Requests run on their own threads. Hold this lock to touch db, state or
+# _cache; responses are snapshotted under it and written after release.
+db_lock = threading.RLock()
+
+# Encoded GET responses: (endpoint, args) -> (db.version when encoded, body)
+_cache: dict[tuple[Any, ...], tuple[int, bytes]] = {}
+_CACHE_MAX_ENTRIES = 256
+
+# Compact separators, same as JSON.stringify in the Node collector. Output
+# stays ASCII so lone surrogates (e.g. a truncated emoji in choiceText) are
+# escaped rather than failing to encode as UTF-8.
+# Responses are freshly built trees, so the circular-reference check is skipped.
+_encoder = json.JSONEncoder(check_circular=False, separators=(",", ":"))
+
+# Streamed responses are flushed in chunks of roughly this many bytes
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def encode_json(data: Any) -> bytes:
+    """Encode a response body as compact UTF-8 JSON."""
+    return _encoder.encode(data).encode("utf-8")
+
+
+def store_events(
+    entries: list[dict[str, Any]], choices: list[ChoiceEvent | None]
+) -> int:
+    """
+    Store, aggregate and save events, evicting the oldest beyond MAX_EVENTS.
+
+    Evicted events are un-counted from the running aggregates; a session
+    whose start or end time was evicted has it recomputed from its
+    remaining events. Eviction drops an extra tenth of MAX_EVENTS each time
+    it runs, so that recompute, and the copy that trims EVENTS_FILE, happen
+    once per that many events rather than on every request. Events are
+    saved before db and state change, so if saving fails nothing is stored.
+    Call with db_lock held.
+
+    Args:
+        entries: Log entries
+        choices: ``parse_choice(entry)`` for each entry
+
+    Returns:
+        Number of events evicted
+    """
+    evicting = 0
+    if len(db) + len(entries) > MAX_EVENTS:
+        evicting = len(db) + len(entries) - (MAX_EVENTS - MAX_EVENTS // 10)
+
+    if events_log is not None:
+        if evicting:
+            # The file holds the same events as db, oldest first
+            saved = min(evicting, len(db))
+            events_log.trim(saved, entries[evicting - saved :])
+        else:
+            events_log.append(entries)
+
+    for entry, choice in zip(entries, choices):
+        db.append(entry)
+        ingest(entry, choice)
+    if not evicting:
+        return 0
+
+    evicted_by_session: dict[str, list[dict[str, Any]]] = {}
+    for entry in db.evict(evicting):
+        discard(entry, parse_choice(entry))
+        evicted_by_session.setdefault(entry.get("sessionId", ""), []).append(entry)
+    for sid, evicted in evicted_by_session.items():
+        update_session_times(state, sid, evicted, db.by_session.get(sid, []))
+    return evicting
+
+
+def load_events_file(path: str) -> int:
+    """
+    Restore db from an events file, then save new events to it.
+
+    The file is opened for appending first, so an unusable path fails here
+    at startup rather than on every later POST.
+
+    Args:
+        path: JSON Lines file written by a previous run (may not exist yet)
+
+    Returns:
+        Number of events restored
+
+    Raises:
+        OSError: If the file can't be opened for appending
+    """
+    global events_log
+
+    log = EventLog(path)
+    log.open()
+    read = 0
+    with db_lock:
+        for entry in log.load():
+            read += 1
+            intern_strings(entry)
+            store_events([entry], [parse_choice(entry)])
+        # Drop unreadable lines and anything evicted while replaying
+        if log.skipped or read != len(db):
+            log.rewrite(db.all)
+        events_log = log
+    return len(db)
 
 
 class AnalyticsHandler(BaseHTTPRequestHandler):
     """HTTP request handler for analytics endpoints."""
 
+    # HTTP/1.1 for chunked streaming responses (and keep-alive)
+    protocol_version = "HTTP/1.1"
+
+    # Close connections left idle this many seconds. Each open connection
+    # holds a thread, and keep-alive clients may never close theirs.
+    timeout = 30
+
+    # Buffer writes so status line, headers and body of a typical response
+    # leave in one send() instead of one per write. BaseHTTPRequestHandler
+    # flushes after each request; larger writes bypass the buffer.
+    wbufsize = 64 * 1024
+
     def _set_cors_headers(self) -> None:
         """Set CORS headers for all responses."""
         self.send_header("Access-Control-Allow-Origin", "*")
@@ -35,14 +370,78 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
 
     def _send_json(self, data: Any, status: int = 200) -> None:
         """Send JSON response with CORS headers."""
-        body = json.dumps(data).encode("utf-8")
+        self._send_body(encode_json(data), status)
+
+    def _send_body(self, body: bytes, status: int = 200) -> None:
+        """Send already-encoded JSON response with CORS headers."""
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
         self._set_cors_headers()
         self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
         self.wfile.write(body)
 
+    def _send_cached(self, key: tuple[Any, ...], render: Callable[[], Any]) -> None:
+        """Send an aggregate response, re-rendering only if db has changed."""
+        with db_lock:
+            cached = _cache.get(key)
+            if cached is None or cached[0] != db.version:
+                if key not in _cache and len(_cache) >= _CACHE_MAX_ENTRIES:
+                    _cache.clear()
+                cached = _cache[key] = (db.version, encode_json(render()))
+        self._send_body(cached[1])
+
+    def _send_json_stream(self, items: Iterable[Any]) -> None:
+        """Stream a JSON array response without building the encoded body.
+
+        Items are encoded and sent in 64 KiB chunks, so only the items
+        themselves are held in memory, not their full JSON text. Uses
+        chunked transfer encoding; HTTP/1.0 clients get the body delimited
+        by closing the connection instead.
+        """
+        chunked = self.request_version == "HTTP/1.1"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self._set_cors_headers()
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+        def write(data: bytes) -> None:
+            if chunked:
+                data = b"%x\r\n%s\r\n" % (len(data), data)
+            self.wfile.write(data)
+
+        buffer = [b"["]
+        size = 1
+        separator = b""
+        try:
+            for item in items:
+                body = encode_json(item)
+                buffer.append(separator)
+                buffer.append(body)
+                separator = b","
+                size += len(body) + 1
+                if size >= _STREAM_CHUNK_SIZE:
+                    write(b"".join(buffer))
+                    buffer = []
+                    size = 0
+        except Exception as e:
+            # Headers are already sent: drop the connection mid-body so the
+            # client sees a truncated response rather than a valid one
+            self._log(f"Error: {e}")
+            self.close_connection = True
+            return
+
+        buffer.append(b"]")
+        write(b"".join(buffer))
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
     def _send_status(self, status: int) -> None:
         """Send status-only response with CORS headers."""
         self.send_response(status)
@@ -77,14 +476,27 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
             if path == "/events":
                 entry = self._read_body()
 
-                if not entry or not entry.get("type") or not entry.get("sessionId"):
+                if (
+                    not isinstance(entry, dict)
+                    or not entry.get("type")
+                    or not entry.get("sessionId")
+                ):
                     self._send_json(
                         {"error": "Invalid event: requires type and sessionId"}, 400
                     )
                     return
+                error = entry_error(entry)
+                if error:
+                    self._send_json({"error": f"Invalid event: {error}"}, 400)
+                    return
 
-                db.append(entry)
+                intern_strings(entry)
+                choice = parse_choice(entry)
+                with db_lock:
+                    evicted = store_events([entry], [choice])
                 self._log(f"Event: {entry['type']} from {entry['sessionId']}")
+                if evicted:
+                    self._log(f"Evicted {evicted} oldest events")
                 self._send_status(200)
                 return
 
@@ -99,13 +511,29 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
                         {"error": "Invalid batch: requires entries array"}, 400
                     )
                     return
-
-                db.extend(entries)
+                # Reject the whole batch before storing any of it, so a
+                # client retry can't double-count the entries before a bad one
+                for i, entry in enumerate(entries):
+                    error = entry_error(entry)
+                    if error:
+                        self._send_json(
+                            {"error": f"Invalid batch: entries[{i}]: {error}"}, 400
+                        )
+                        return
+
+                for entry in entries:
+                    intern_strings(entry)
+                choices = [parse_choice(entry) for entry in entries]
+                with db_lock:
+                    evicted = store_events(entries, choices)
                 self._log(f"Batch: {len(entries)} events from {session_id}")
+                if evicted:
+                    self._log(f"Evicted {evicted} oldest events")
                 self._send_status(200)
                 return
 
-            # 404 Not Found
+            # 404 Not Found (body left unread, so don't reuse the connection)
+            self.close_connection = True
             self._send_json({"error": "Not Found"}, 404)
 
         except json.JSONDecodeError:
@@ -123,7 +551,7 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
         try:
             # GET /stats - Aggregated choice statistics
             if path == "/stats":
-                self._send_json(compute_path_stats(db))
+                self._send_cached(("stats",), lambda: render_path_stats(state))
                 return
 
             # GET /stats/choices - Telltale-style choice statistics
@@ -137,18 +565,27 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
                     )
                     return
 
-                self._send_json(compute_choice_stats(db, choice_ids))
+                self._send_cached(
+                    ("stats/choices", *choice_ids),
+                    lambda: render_choice_stats(state, choice_ids),
+                )
                 return
 
             # GET /sessions - Session summaries
             if path == "/sessions":
-                self._send_json(compute_session_summaries(db))
+                # Snapshot under the lock since handler threads mutate state;
+                # only the encoding is streamed
+                with db_lock:
+                    sessions = list(render_session_summaries(state))
+                self._send_json_stream(sessions)
                 return
 
             # GET /top-paths - Most visited paths
             if path == "/top-paths":
                 limit = int(query.get("limit", ["10"])[0])
-                self._send_json(top_paths(db, limit))
+                self._send_cached(
+                    ("top-paths", limit), lambda: render_top_paths(state, limit)
+                )
                 return
 
             # GET /events - Raw events (for debugging)
@@ -157,14 +594,9 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
                 event_type = query.get("type", [None])[0]
                 session_id = query.get("sessionId", [None])[0]
 
-                filtered = db
-
-                if event_type:
-                    filtered = [e for e in filtered if e.get("type") == event_type]
-                if session_id:
-                    filtered = [e for e in filtered if e.get("sessionId") == session_id]
-
-                self._send_json(filtered[-limit:])
+                with db_lock:
+                    events = db.filter(event_type, session_id)[-limit:]
+                self._send_json_stream(events)
                 return
 
             # GET /health - Health check
@@ -186,7 +618,12 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
 
         # DELETE /events - Clear all events (for testing)
         if path == "/events":
-            db.clear()
+            with db_lock:
+                if events_log is not None:
+                    events_log.rewrite([])
+                db.clear()
+                state.clear()
+                _cache.clear()
             self._log("Events cleared")
             self._send_status(200)
             return
@@ -201,7 +638,14 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
 
 def main() -> None:
     """Start the analytics collector server."""
-    server = HTTPServer(("", PORT), AnalyticsHandler)
+    if EVENTS_FILE:
+        try:
+            count = load_events_file(EVENTS_FILE)
+        except OSError as e:
+            sys.exit(f"Cannot open EVENTS_FILE: {e}")
+        print(f"Loaded {count} events from {EVENTS_FILE}")
+
+    server = ThreadingHTTPServer(("", PORT), AnalyticsHandler)
 
     print(f"Analytics collector running on http://localhost:{PORT}")
     print()
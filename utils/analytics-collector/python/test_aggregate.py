@@ -0,0 +1,220 @@
+"""Tests for the aggregation functions (stdlib only).
+
+Run from this directory with: python -m unittest
+"""
+
+import unittest
+from collections.abc import Iterable
+from typing import Any
+
+from aggregate import (
+    AggregateState,
+    compute_choice_stats,
+    compute_path_stats,
+    compute_session_summaries,
+    make_discard,
+    make_ingest,
+    parse_choice,
+    update_session_times,
+    render_choice_stats,
+    render_path_stats,
+    render_session_summaries,
+    render_top_paths,
+    top_paths,
+)
+
+ENTRIES: list[dict[str, Any]] = [
+    {"type": "session_start", "sessionId": "s1", "timestamp": 200},
+    {
+        "type": "choice",
+        "sessionId": "s1",
+        "timestamp": 300,
+        "payload": {"knotPath": "pat", "choiceIndex": 0, "choiceText": "Call"},
+    },
+    {
+        "type": "choice",
+        "sessionId": "s1",
+        "timestamp": 100,
+        "payload": {"knotPath": "news", "choiceIndex": 1, "choiceText": "Read"},
+    },
+    {
+        "type": "choice",
+        "sessionId": "s2",
+        "timestamp": 150,
+        # Later texts for the same choice don't replace the first one
+        "payload": {"knotPath": "pat", "choiceIndex": 0, "choiceText": "Later"},
+    },
+    {
+        "type": "choice",
+        "sessionId": "s2",
+        "timestamp": 500,
+        "payload": {"knotPath": "pat", "choiceIndex": 1, "choiceText": "Wait"},
+    },
+    {
+        "type": "choice",
+        "sessionId": "s1",
+        "timestamp": 250,
+        "payload": {"knotPath": "pat", "choiceIndex": 1, "choiceText": "Wait"},
+    },
+    # No knotPath: counted under "unknown", knot taken from context
+    {
+        "type": "choice",
+        "sessionId": "s3",
+        "timestamp": 50,
+        "payload": {"choiceIndex": 2},
+        "context": {"knot": "chat"},
+    },
+    {"type": "view", "sessionId": "s3", "timestamp": 80, "payload": None},
+]
+
+
+def unordered_sessions(
+    sessions: Iterable[dict[str, Any]],
+) -> dict[str, dict[str, Any]]:
+    """Session summaries by ID, with paths as a set (eviction keeps the
+    order sessions and paths were first seen)."""
+    return {s["sessionId"]: {**s, "paths": set(s["paths"])} for s in sessions}
+
+
+class ComputeTest(unittest.TestCase):
+    def test_path_stats(self):
+        self.assertEqual(
+            compute_path_stats(ENTRIES),
+            {
+                "totalChoices": 6,
+                "uniqueSessions": 3,
+                "pathDistribution": {
+                    "pat": {
+                        "0": {"count": 2, "text": "Call"},
+                        "1": {"count": 2, "text": "Wait"},
+                    },
+                    "news": {"1": {"count": 1, "text": "Read"}},
+                    "unknown": {"2": {"count": 1, "text": ""}},
+                },
+            },
+        )
+
+    def test_session_summaries(self):
+        self.assertEqual(
+            compute_session_summaries(ENTRIES),
+            [
+                {
+                    "sessionId": "s1",
+                    "startTime": 100,
+                    "endTime": 300,
+                    "choiceCount": 3,
+                    "paths": ["pat", "news"],
+                    "durationMs": 200,
+                },
+                {
+                    "sessionId": "s2",
+                    "startTime": 150,
+                    "endTime": 500,
+                    "choiceCount": 2,
+                    "paths": ["pat"],
+                    "durationMs": 350,
+                },
+                {
+                    "sessionId": "s3",
+                    "startTime": 50,
+                    "endTime": 80,
+                    "choiceCount": 1,
+                    "paths": [],
+                    "durationMs": 30,
+                },
+            ],
+        )
+
+    def test_top_paths(self):
+        self.assertEqual(
+            top_paths(ENTRIES),
+            [
+                {"path": "pat", "count": 4},
+                {"path": "news", "count": 1},
+                {"path": "unknown", "count": 1},
+            ],
+        )
+        self.assertEqual(top_paths(ENTRIES, 1), [{"path": "pat", "count": 4}])
+
+    def test_choice_stats(self):
+        self.assertEqual(
+            compute_choice_stats(ENTRIES, ["pat:0", "pat:1", "chat:2", "pat:9"]),
+            {
+                "choices": {
+                    "pat:0": {"total": 2, "percentage": 50},
+                    "pat:1": {"total": 2, "percentage": 50},
+                    "chat:2": {"total": 1, "percentage": 100},
+                    "pat:9": {"total": 0, "percentage": 0},
+                }
+            },
+        )
+
+    def test_empty(self):
+        self.assertEqual(
+            compute_path_stats([]),
+            {"totalChoices": 0, "uniqueSessions": 0, "pathDistribution": {}},
+        )
+        self.assertEqual(compute_session_summaries([]), [])
+        self.assertEqual(top_paths([]), [])
+
+
+class RunningStateTest(unittest.TestCase):
+    def test_renders_match_batch_computation(self):
+        state = AggregateState()
+        ingest = make_ingest(state)
+        for entry in ENTRIES:
+            ingest(entry, parse_choice(entry))
+
+        ids = ["pat:0", "news:1", "chat:2", "unknown:2"]
+        self.assertEqual(render_path_stats(state), compute_path_stats(ENTRIES))
+        self.assertEqual(
+            list(render_session_summaries(state)), compute_session_summaries(ENTRIES)
+        )
+        self.assertEqual(render_top_paths(state, 2), top_paths(ENTRIES, 2))
+        self.assertEqual(
+            render_choice_stats(state, ids), compute_choice_stats(ENTRIES, ids)
+        )
+
+    def test_clear_keeps_ingest_usable(self):
+        state = AggregateState()
+        ingest = make_ingest(state)
+        for entry in ENTRIES:
+            ingest(entry, parse_choice(entry))
+        state.clear()
+        for entry in ENTRIES[:3]:
+            ingest(entry, parse_choice(entry))
+
+        self.assertEqual(render_path_stats(state), compute_path_stats(ENTRIES[:3]))
+
+    def test_discard_matches_batch_computation(self):
+        ids = ["pat:0", "news:1", "chat:2", "unknown:2"]
+        for evicted in range(len(ENTRIES) + 1):
+            state = AggregateState()
+            ingest = make_ingest(state)
+            discard = make_discard(state)
+            for entry in ENTRIES:
+                ingest(entry, parse_choice(entry))
+            for entry in ENTRIES[:evicted]:
+                discard(entry, parse_choice(entry))
+            rest = ENTRIES[evicted:]
+            for sid in {entry["sessionId"] for entry in ENTRIES[:evicted]}:
+                update_session_times(
+                    state,
+                    sid,
+                    [e for e in ENTRIES[:evicted] if e["sessionId"] == sid],
+                    [e for e in rest if e["sessionId"] == sid],
+                )
+
+            with self.subTest(evicted=evicted):
+                self.assertEqual(render_path_stats(state), compute_path_stats(rest))
+                self.assertEqual(
+                    unordered_sessions(render_session_summaries(state)),
+                    unordered_sessions(compute_session_summaries(rest)),
+                )
+                self.assertEqual(
+                    render_choice_stats(state, ids), compute_choice_stats(rest, ids)
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
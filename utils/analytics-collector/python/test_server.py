@@ -0,0 +1,505 @@
+"""Tests for the analytics collector server (stdlib only).
+
+Run from this directory with: python -m unittest
+"""
+
+import http.client
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from typing import Any
+from unittest import mock
+
+import server
+from aggregate import (
+    compute_choice_stats,
+    compute_path_stats,
+    compute_session_summaries,
+    top_paths,
+)
+from test_aggregate import unordered_sessions
+
+
+def choice_event(
+    session_id: str, timestamp: int, knot_path: str, choice_index: int
+) -> dict[str, Any]:
+    """Build a choice event as the game's EventLogger sends it."""
+    return {
+        "type": "choice",
+        "sessionId": session_id,
+        "timestamp": timestamp,
+        "payload": {
+            "knotPath": knot_path,
+            "choiceIndex": choice_index,
+            "choiceText": f"Option {choice_index}",
+        },
+    }
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs the real handler on an ephemeral port, with empty storage."""
+
+    def setUp(self) -> None:
+        log_patch = mock.patch.object(server.AnalyticsHandler, "_log")
+        log_patch.start()
+        self.addCleanup(log_patch.stop)
+
+        self.httpd = server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), server.AnalyticsHandler
+        )
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        # Cleanups run last-in first-out: stop serving, then close the socket
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+        self.request("DELETE", "/events")
+
+    def detach_log(self) -> None:
+        """Stop saving to the events file, as if the server had stopped."""
+        if server.events_log is not None:
+            server.events_log.close()
+            server.events_log = None
+
+    def connect(self) -> http.client.HTTPConnection:
+        """Open a connection to the test server."""
+        port = self.httpd.server_address[1]
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: Any = None,
+        conn: http.client.HTTPConnection | None = None,
+    ) -> tuple[http.client.HTTPResponse, Any]:
+        """Send a request and return the response with its parsed JSON body."""
+        conn = conn or self.connect()
+        data = json.dumps(body) if body is not None else None
+        conn.request(method, path, data, {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        raw = response.read()
+        return response, json.loads(raw) if raw else None
+
+    def post_events(self, entries: list[dict[str, Any]]) -> None:
+        """Ingest events one by one through POST /events."""
+        conn = self.connect()
+        for entry in entries:
+            response, _ = self.request("POST", "/events", entry, conn)
+            self.assertEqual(response.status, 200)
+
+
+class CacheTest(ServerTestCase):
+    def test_post_invalidates_cached_stats(self):
+        self.post_events([choice_event("s1", 1, "pat.start", 0)])
+        _, first = self.request("GET", "/stats")
+        _, repeat = self.request("GET", "/stats")
+        self.assertEqual(first, repeat)
+        self.assertEqual(first["totalChoices"], 1)
+
+        self.post_events([choice_event("s2", 2, "pat.start", 1)])
+        _, stats = self.request("GET", "/stats")
+        self.assertEqual(stats["totalChoices"], 2)
+        self.assertEqual(stats["uniqueSessions"], 2)
+
+    def test_batch_invalidates_cached_top_paths(self):
+        self.post_events([choice_event("s1", 1, "pat.start", 0)])
+        _, before = self.request("GET", "/top-paths?limit=5")
+        self.assertEqual(before, [{"path": "pat.start", "count": 1}])
+
+        batch = [choice_event("s2", t, "news.a", 0) for t in range(3)]
+        self.request("POST", "/batch", {"sessionId": "s2", "entries": batch})
+        _, after = self.request("GET", "/top-paths?limit=5")
+        self.assertEqual(
+            after,
+            [{"path": "news.a", "count": 3}, {"path": "pat.start", "count": 1}],
+        )
+
+    def test_delete_invalidates_cached_choice_stats(self):
+        self.post_events([choice_event("s1", 1, "pat", 0)] * 3)
+        query = "/stats/choices?choice=pat:0"
+        _, stats = self.request("GET", query)
+        self.assertEqual(stats["choices"]["pat:0"], {"total": 3, "percentage": 100})
+
+        self.request("DELETE", "/events")
+        _, stats = self.request("GET", query)
+        self.assertEqual(stats["choices"]["pat:0"], {"total": 0, "percentage": 0})
+
+        # Same number of events as before the clear, but different content
+        self.post_events([choice_event("s1", 1, "pat", 1)] * 3)
+        _, stats = self.request("GET", query)
+        self.assertEqual(stats["choices"]["pat:0"], {"total": 0, "percentage": 0})
+
+
+class StreamingTest(ServerTestCase):
+    def test_events_are_chunked_and_filtered(self):
+        entries = [choice_event(f"s{i % 3}", i, "pat", i % 2) for i in range(50)]
+        entries.append({"type": "view", "sessionId": "s1", "timestamp": 50})
+        self.post_events(entries)
+
+        response, body = self.request("GET", "/events?limit=1000")
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        self.assertEqual(body, entries)
+
+        _, body = self.request("GET", "/events?limit=5&sessionId=s1")
+        self.assertEqual(body, [e for e in entries if e["sessionId"] == "s1"][-5:])
+
+        _, body = self.request("GET", "/events?type=view&sessionId=s1")
+        self.assertEqual(body, entries[-1:])
+
+    def test_large_events_response_spans_several_chunks(self):
+        padding = "x" * 1000
+        entries = [
+            {"type": "view", "sessionId": "s1", "timestamp": i, "pad": padding}
+            for i in range(200)
+        ]
+        self.request("POST", "/batch", {"sessionId": "s1", "entries": entries})
+
+        _, body = self.request("GET", "/events?limit=1000")
+        self.assertEqual(body, entries)
+
+    def test_sessions_are_chunked(self):
+        self.post_events(
+            [
+                choice_event("s1", 100, "pat.start", 0),
+                choice_event("s1", 400, "pat.inquiry", 1),
+                choice_event("s2", 250, "pat.start", 1),
+            ]
+        )
+
+        response, body = self.request("GET", "/sessions")
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        self.assertEqual(
+            body,
+            [
+                {
+                    "sessionId": "s1",
+                    "startTime": 100,
+                    "endTime": 400,
+                    "choiceCount": 2,
+                    "paths": ["pat.start", "pat.inquiry"],
+                    "durationMs": 300,
+                },
+                {
+                    "sessionId": "s2",
+                    "startTime": 250,
+                    "endTime": 250,
+                    "choiceCount": 1,
+                    "paths": ["pat.start"],
+                    "durationMs": 0,
+                },
+            ],
+        )
+
+    def test_empty_sessions(self):
+        _, body = self.request("GET", "/sessions")
+        self.assertEqual(body, [])
+
+
+class ConnectionTest(ServerTestCase):
+    def test_requests_share_a_keep_alive_connection(self):
+        conn = self.connect()
+        self.request("POST", "/events", choice_event("s1", 1, "pat", 0), conn)
+        self.request("GET", "/sessions", conn=conn)
+        response, body = self.request("GET", "/health", conn=conn)
+        self.assertFalse(response.will_close)
+        self.assertEqual(body, {"status": "ok", "eventCount": 1})
+
+    def test_unknown_post_closes_connection(self):
+        response, body = self.request("POST", "/nope", {"ignored": True})
+        self.assertEqual(response.status, 404)
+        self.assertEqual(body, {"error": "Not Found"})
+        self.assertEqual(response.getheader("Connection"), "close")
+        self.assertTrue(response.will_close)
+
+    def test_idle_connection_is_closed(self):
+        with mock.patch.object(server.AnalyticsHandler, "timeout", 0.1):
+            sock = socket.create_connection(self.httpd.server_address, timeout=5)
+            self.addCleanup(sock.close)
+            self.assertEqual(sock.recv(1), b"")
+
+
+class ValidationTest(ServerTestCase):
+    def test_bad_batch_entry_rejects_whole_batch(self):
+        bad = choice_event("s1", 2, "pat", 0)
+        bad["payload"]["knotPath"] = ["pat", "start"]
+        entries = [
+            choice_event("s1", 1, "pat", 0),
+            bad,
+            {"type": "view", "sessionId": "s1", "timestamp": 3},
+        ]
+
+        response, body = self.request(
+            "POST", "/batch", {"sessionId": "s1", "entries": entries}
+        )
+        self.assertEqual(response.status, 400)
+        self.assertIn("entries[1]", body["error"])
+
+        _, health = self.request("GET", "/health")
+        self.assertEqual(health["eventCount"], 0)
+        _, stats = self.request("GET", "/stats")
+        self.assertEqual(stats["totalChoices"], 0)
+        _, sessions = self.request("GET", "/sessions")
+        self.assertEqual(sessions, [])
+
+    def test_unstorable_events_are_rejected(self):
+        def with_payload(**payload: Any) -> dict[str, Any]:
+            entry = choice_event("s1", 1, "pat", 0)
+            entry["payload"].update(payload)
+            return entry
+
+        cases = [
+            ["not", "an", "object"],
+            {"type": ["choice"], "sessionId": "s1"},
+            {"type": "view", "sessionId": {"id": 1}},
+            {"type": "view", "sessionId": "s1", "timestamp": "yesterday"},
+            {"type": "choice", "sessionId": "s1", "payload": "pat:0"},
+            {"type": "choice", "sessionId": "s1", "context": {"knot": [1]}},
+            with_payload(knotPath={"name": "pat"}),
+            with_payload(choiceIndex=[0]),
+        ]
+        self.post_events([choice_event("s1", 5, "pat", 0)])
+        for entry in cases:
+            with self.subTest(entry=entry):
+                response, _ = self.request("POST", "/events", entry)
+                self.assertEqual(response.status, 400)
+
+        _, health = self.request("GET", "/health")
+        self.assertEqual(health["eventCount"], 1)
+        _, sessions = self.request("GET", "/sessions")
+        self.assertEqual(sessions[0]["startTime"], 5)
+
+
+class EncodingTest(ServerTestCase):
+    def test_lone_surrogate_is_escaped(self):
+        # A client that truncates an emoji between its UTF-16 halves
+        entry = choice_event("s1", 1, "pat", 0)
+        entry["payload"]["choiceText"] = "Sure \ud83d"
+        self.post_events([entry])
+
+        for path in ("/stats", "/events", "/sessions"):
+            response, _ = self.request("GET", path)
+            self.assertEqual(response.status, 200, path)
+        _, stats = self.request("GET", "/stats")
+        self.assertEqual(
+            stats["pathDistribution"]["pat"]["0"]["text"], "Sure \ud83d"
+        )
+
+    def test_lone_surrogate_is_written_to_events_file(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "events.jsonl")
+        log = server.EventLog(path)
+        log.open()
+        self.addCleanup(log.close)
+        with mock.patch.object(server, "events_log", log):
+            entry = choice_event("s1", 1, "pat", 0)
+            entry["payload"]["choiceText"] = "\ud83d"
+            self.post_events([entry])
+
+        self.assertEqual(list(server.EventLog(path).load()), [entry])
+
+
+class EventsFileTest(ServerTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "events.jsonl")
+        self.addCleanup(self.detach_log)
+
+    def restart(self) -> int:
+        """Drop everything in memory and reload it from the events file."""
+        self.detach_log()
+        self.request("DELETE", "/events")
+        return server.load_events_file(self.path)
+
+    def test_events_round_trip(self):
+        self.assertEqual(server.load_events_file(self.path), 0)
+        entries = [choice_event("s1", t, f"k{t % 3}", t % 2) for t in range(10)]
+        self.post_events(entries[:4])
+        self.request("POST", "/batch", {"sessionId": "s1", "entries": entries[4:]})
+        _, stats = self.request("GET", "/stats")
+        _, sessions = self.request("GET", "/sessions")
+
+        self.assertEqual(self.restart(), 10)
+        _, events = self.request("GET", "/events?limit=100")
+        self.assertEqual(events, entries)
+        self.assertEqual(self.request("GET", "/stats")[1], stats)
+        self.assertEqual(self.request("GET", "/sessions")[1], sessions)
+
+        # Appends continue after the reloaded events
+        self.post_events([choice_event("s2", 20, "k0", 0)])
+        self.assertEqual(self.restart(), 11)
+
+    def test_delete_empties_events_file(self):
+        server.load_events_file(self.path)
+        self.post_events([choice_event("s1", 1, "pat", 0)])
+        self.request("DELETE", "/events")
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(self.restart(), 0)
+
+    def test_unreadable_lines_are_dropped(self):
+        entry = choice_event("s1", 1, "pat", 0)
+        with open(self.path, "w") as f:
+            f.write(json.dumps(entry) + "\n" + '{"type": "cho')
+
+        self.assertEqual(server.load_events_file(self.path), 1)
+        self.post_events([choice_event("s1", 2, "pat", 1)])
+        self.assertEqual(self.restart(), 2)
+
+    def test_invalid_events_are_dropped(self):
+        entry = choice_event("s1", 1, "pat", 0)
+        invalid = choice_event("s1", 2, "pat", 1)
+        invalid["payload"]["knotPath"] = ["a"]
+        with open(self.path, "w") as f:
+            f.write(json.dumps(entry) + "\n" + json.dumps(invalid) + "\n[]\n")
+
+        self.assertEqual(server.load_events_file(self.path), 1)
+        self.assertEqual(server.events_log.skipped, 2)
+        self.assertEqual(self.restart(), 1)
+
+    def test_unusable_path_fails_at_load(self):
+        path = os.path.join(os.path.dirname(self.path), "missing", "events.jsonl")
+        with self.assertRaises(OSError):
+            server.load_events_file(path)
+        self.assertIsNone(server.events_log)
+
+    def test_failed_save_stores_nothing(self):
+        server.load_events_file(self.path)
+        with mock.patch.object(
+            server.EventLog, "append", side_effect=OSError("disk full")
+        ):
+            response, _ = self.request(
+                "POST", "/events", choice_event("s1", 1, "pat", 0)
+            )
+        self.assertEqual(response.status, 500)
+
+        _, health = self.request("GET", "/health")
+        self.assertEqual(health["eventCount"], 0)
+        _, stats = self.request("GET", "/stats")
+        self.assertEqual(stats["totalChoices"], 0)
+
+
+class EvictionTest(ServerTestCase):
+    MAX_EVENTS = 10
+
+    def setUp(self) -> None:
+        super().setUp()
+        cap_patch = mock.patch.object(server, "MAX_EVENTS", self.MAX_EVENTS)
+        cap_patch.start()
+        self.addCleanup(cap_patch.stop)
+
+    def make_events(self, count: int, start: int = 0) -> list[dict[str, Any]]:
+        """Events over a few sessions and knots, with out-of-order timestamps."""
+        entries = []
+        for i in range(start, start + count):
+            if i % 4 == 3:
+                entry = {"type": "view", "sessionId": f"s{i % 3}"}
+                entry["timestamp"] = 1000 - i
+            else:
+                entry = choice_event(f"s{i % 3}", (i * 37) % 100, f"k{i % 5}", i % 2)
+                entry["payload"]["choiceText"] = f"Text {i}"
+            entries.append(entry)
+        return entries
+
+    def assert_served_from(self, retained: list[dict[str, Any]]) -> None:
+        """
+        Check every endpoint matches a fresh aggregation of ``retained``.
+
+        Sessions, their paths, and top paths with equal counts stay in the
+        order first seen before eviction, so those orders aren't compared.
+        """
+        ids = [f"k{k}:{i}" for k in range(5) for i in range(2)]
+        _, events = self.request("GET", "/events?limit=1000")
+        self.assertEqual(events, retained)
+        self.assertEqual(self.request("GET", "/stats")[1], compute_path_stats(retained))
+
+        self.assertEqual(
+            unordered_sessions(self.request("GET", "/sessions")[1]),
+            unordered_sessions(compute_session_summaries(retained)),
+        )
+
+        _, paths = self.request("GET", "/top-paths?limit=1000")
+        counts = [p["count"] for p in paths]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertEqual(
+            {p["path"]: p["count"] for p in paths},
+            {p["path"]: p["count"] for p in top_paths(retained, 1000)},
+        )
+
+        self.assertEqual(
+            self.request("GET", "/stats/choices?choice=" + "&choice=".join(ids))[1],
+            compute_choice_stats(retained, ids),
+        )
+
+    def test_single_events_evict_oldest(self):
+        keep = self.MAX_EVENTS - self.MAX_EVENTS // 10
+        expected: list[dict[str, Any]] = []
+        for entry in self.make_events(25):
+            self.post_events([entry])
+            expected.append(entry)
+            if len(expected) > self.MAX_EVENTS:
+                expected = expected[-keep:]
+            self.assert_served_from(expected)
+
+    def test_batch_larger_than_cap(self):
+        self.post_events(self.make_events(5))
+        entries = self.make_events(15, start=5)
+        self.request("POST", "/batch", {"sessionId": "s1", "entries": entries})
+        self.assert_served_from(entries[-9:])
+
+    def test_eviction_trims_events_file(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(self.detach_log)
+        path = os.path.join(tmp.name, "events.jsonl")
+        server.load_events_file(path)
+
+        entries = self.make_events(12)
+        self.post_events(entries)
+        self.assert_served_from(entries[-10:])
+
+        self.detach_log()
+        self.request("DELETE", "/events")
+        self.assertEqual(server.load_events_file(path), 10)
+        self.assert_served_from(entries[-10:])
+
+
+class ConcurrencyTest(ServerTestCase):
+    def test_concurrent_ingest_and_reads(self):
+        def post(session_id: str) -> None:
+            self.post_events(
+                [choice_event(session_id, t, f"k{t % 4}", t % 2) for t in range(50)]
+            )
+
+        statuses: list[int] = []
+
+        def read() -> None:
+            conn = self.connect()
+            for _ in range(20):
+                for path in ("/stats", "/sessions", "/top-paths", "/events"):
+                    response, _ = self.request("GET", path, conn=conn)
+                    statuses.append(response.status)
+
+        threads = [threading.Thread(target=post, args=(f"s{i}",)) for i in range(4)]
+        threads += [threading.Thread(target=read) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * 160)
+        _, stats = self.request("GET", "/stats")
+        self.assertEqual(stats["totalChoices"], 200)
+        self.assertEqual(stats["uniqueSessions"], 4)
+        _, health = self.request("GET", "/health")
+        self.assertEqual(health["eventCount"], 200)
+
+
+if __name__ == "__main__":
+    unittest.main()